@@ -1,84 +1,634 @@
+import io
+import itertools
+import multiprocessing
 import os
+import pickle
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import closing
+from dataclasses import dataclass
+from functools import partial
 from pathlib import Path
-from typing import Callable
+from typing import Callable, Iterator, Optional
 
 import numpy as np
-import pandas as pd
-from PIL import Image
+from PIL import Image, __version__ as PIL_VERSION
 
+try:
+    import simplejpeg
+except ImportError:  # optional; Pillow handles JPEGs without it
+    simplejpeg = None
+
+try:
+    import imagecodecs
+except ImportError:  # optional; Pillow handles PNGs without it
+    imagecodecs = None
+
+try:
+    from nvidia import nvimgcodec
+except ImportError:  # optional; only used by backend="nvimgcodec"
+    nvimgcodec = None
+
+try:
+    from spdl.pipeline import PipelineBuilder
+except ImportError:  # optional; only used by backend="spdl"
+    PipelineBuilder = None
+
+# Pillow-SIMD releases carry a ".postN" suffix; stock Pillow does not
+PILLOW_SIMD = ".post" in PIL_VERSION
+
+JPEG_SUFFIXES = ('.jpg', '.jpeg')
+
+# Lowercased image extensions (without the dot); see is_image_name
+IMG_EXTS = frozenset({'png', 'jpg', 'jpeg', 'bmp', 'tiff', 'tif', 'gif'})
+
+# Leading magic bytes of the formats we accept, checked on data already in memory
+_MAGIC = (
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF8', 'gif'),
+    (b'BM', 'bmp'),
+    (b'II*\x00', 'tiff'),
+    (b'MM\x00*', 'tiff'),
+)
+
+# Accepted values for process_images(backend=...)
+BACKENDS = ("auto", "nvimgcodec", "spdl")
+
+# Below this many images, spawning worker processes costs more than it saves
+PROCESS_POOL_MIN_IMAGES = 32
+
+# Log lines buffered in memory before one writelines() call
+LOG_FLUSH_LINES = 256
+
+# Number of files handed to the GPU decoder per call
+NVIMGCODEC_BATCH_SIZE = 64
+
+# File reads kept in flight ahead of the decoder, and threads issuing them
+PREFETCH_DEPTH = 64
+PREFETCH_THREADS = 8
+
+# Threads per stage of the SPDL pipeline; I/O-bound stages need fewer
+SPDL_READ_CONCURRENCY = 8
+SPDL_SAVE_CONCURRENCY = 4
+
+
+@dataclass(frozen=True)
+class EncodeOpts:
+    """
+    Encoder settings for processed images.
+
+    The defaults favour encode speed over file size: PNGs use zlib level 1
+    instead of Pillow's 6, and JPEGs are written with 4:2:0 subsampling and
+    without optimized Huffman tables or progressive scans.
+    """
+    jpeg_quality: int = 90
+    jpeg_subsampling: str = "4:2:0"
+    png_compress_level: int = 1
+
+
+def is_image_name(name: str) -> bool:
+    """Return True if a file name has an image extension (lowercasing only the extension)."""
+    _, dot, ext = name.rpartition('.')
+    return bool(dot) and ext.lower() in IMG_EXTS
+
+
+def _iter_images(root: Path, skip: set[Path], rel_parent: tuple = ()) -> Iterator[tuple]:
+    """
+    Walk root depth-first with os.scandir and yield image files.
+
+    Directories in skip (e.g. the output folder) are not descended into, and
+    directories that cannot be read are skipped, as os.walk does. The path of
+    each file relative to the walk's starting folder is tracked as a tuple of
+    directory names, extended once per directory rather than recomputed per
+    file.
+
+    Yields:
+        tuple: (os.DirEntry, rel_parent) for every file with an image extension.
+    """
+    subdirs = []
+    try:
+        with os.scandir(root) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    is_dir = False
+
+                if is_dir:
+                    # Compare as Path so "./output" matches Path("output")
+                    if Path(entry.path) not in skip:
+                        subdirs.append(entry)
+                elif is_image_name(entry.name):
+                    yield entry, rel_parent
+    except OSError:
+        # Unreadable directory (e.g. PermissionError); skip it
+        pass
+
+    for entry in subdirs:
+        yield from _iter_images(Path(entry.path), skip, rel_parent + (entry.name,))
+
+
+def collect_image_files_recursive(root_folder: Path) -> list[Path]:
+    """
+    Return every image file under root_folder, using the same walk as
+    process_images. Unreadable subdirectories are skipped, as Path.rglob did.
+    """
+    return [Path(entry.path) for entry, _ in _iter_images(root_folder, set())]
+
+
+def _sniff(head: bytes) -> Optional[str]:
+    """Return the image format named by the leading bytes, or None if unknown."""
+    for magic, fmt in _MAGIC:
+        if head.startswith(magic):
+            return fmt
+    return None
+
+
+# Start-of-frame markers (SOF0-SOF15, minus DHT/JPG/DAC which share the range)
+_JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def _jpeg_components(data: bytes) -> Optional[int]:
+    """Return the number of colour components in a JPEG's frame header, or None."""
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:  # fill byte
+            i += 1
+            continue
+        if marker in _JPEG_SOF_MARKERS:
+            return data[i + 9]
+        i += 2 + int.from_bytes(data[i + 2:i + 4], 'big')
+    return None
+
+
+def _decode(data: bytes) -> np.ndarray:
+    """
+    Decode an in-memory image file into a NumPy array.
+
+    The format is sniffed from the leading bytes so the decoder is picked
+    without Pillow's per-file plugin lookup. JPEGs go through simplejpeg
+    (libjpeg-turbo) and 8-bit PNGs through imagecodecs when those are
+    installed; grayscale JPEGs stay single-channel, as they would with Pillow,
+    instead of being expanded to RGB. Unlike Pillow, imagecodecs expands
+    palette PNGs to RGB rather than returning palette indices. 1/2/4/16-bit
+    PNGs, BMP/TIFF/GIF, or anything those decoders reject, are decoded with
+    Pillow from the same buffer.
+    """
+    fmt = _sniff(data[:16])
+
+    if simplejpeg is not None and fmt == 'jpeg':
+        try:
+            colorspace = simplejpeg.decode_jpeg_header(data)[2]
+            if colorspace == 'Gray':
+                gray = simplejpeg.decode_jpeg(data, colorspace='GRAY', fastdct=True, fastupsample=True)
+                return gray[:, :, 0]
+            return simplejpeg.decode_jpeg(data, colorspace='RGB', fastdct=True, fastupsample=True)
+        except ValueError:
+            pass
+
+    # IHDR bit depth is byte 24; other depths decode differently from Pillow
+    # (uint16 arrays Image.fromarray cannot save, 1-bit widened to 8-bit)
+    if imagecodecs is not None and fmt == 'png' and len(data) > 24 and data[24] == 8:
+        try:
+            array = imagecodecs.png_decode(data)
+            if array.dtype == np.uint8:
+                return array
+        except Exception:
+            pass
+
+    # np.asarray would hand back a read-only view of Pillow's buffer; copy so
+    # process_fn may modify its input in place whichever decoder ran
+    with Image.open(io.BytesIO(data)) as img:
+        return np.array(img)
+
+
+def _load_image(input_path: Path) -> np.ndarray:
+    """Read an image file once and decode it into a NumPy array."""
+    return _decode(input_path.read_bytes())
+
+
+def _save_image(array: np.ndarray, processed_path: Path, opts: EncodeOpts):
+    """
+    Encode array to processed_path with the encoder settings in opts.
+
+    RGB JPEG output goes through simplejpeg when it is available; all other
+    output is written by Pillow, routed by suffix.
+    """
+    # Encoders copy non-contiguous input internally; do it once here instead
+    if not array.flags['C_CONTIGUOUS']:
+        array = np.ascontiguousarray(array)
+
+    suffix = processed_path.suffix.lower()
+    if suffix in JPEG_SUFFIXES:
+        if (
+            simplejpeg is not None
+            and array.dtype == np.uint8
+            and array.ndim == 3
+            and array.shape[2] == 3
+        ):
+            processed_path.write_bytes(simplejpeg.encode_jpeg(
+                array,
+                quality=opts.jpeg_quality,
+                colorspace='RGB',
+                colorsubsampling=opts.jpeg_subsampling.replace(':', ''),
+            ))
+        else:
+            Image.fromarray(array).save(
+                processed_path,
+                quality=opts.jpeg_quality,
+                subsampling=opts.jpeg_subsampling,
+                optimize=False,
+                progressive=False,
+            )
+    elif suffix == '.png':
+        Image.fromarray(array).save(processed_path, optimize=False, compress_level=opts.png_compress_level)
+    else:
+        Image.fromarray(array).save(processed_path)
+
+
+def _apply(process_fn: Callable, array: np.ndarray) -> np.ndarray:
+    """
+    Call process_fn on a decoded HWC image.
+
+    A process_fn with a truthy supports_chw attribute always receives a
+    (C, H, W) view instead; 2-D grayscale images get a leading C=1 axis. Its
+    result is transposed back to HWC (and the added axis dropped again);
+    _save_image makes it contiguous in a single pass.
+    """
+    if getattr(process_fn, 'supports_chw', False):
+        if array.ndim == 2:
+            return process_fn(array[np.newaxis])[0]
+        return np.transpose(process_fn(np.transpose(array, (2, 0, 1))), (1, 2, 0))
+    return process_fn(array)
+
+
+def _skipped(job: tuple, error: Exception) -> tuple:
+    """Build the result tuple for a job that failed at any stage."""
+    input_path, processed_path, stem = job[:3]
+    return stem, processed_path, False, f"⚠️ Skipped unsupported or corrupted file: {input_path} ({error})"
+
+
+def _save_result(job: tuple, processed_array: np.ndarray) -> tuple:
+    """Save a processed image and build the job's result tuple."""
+    _, processed_path, stem, _, encode_opts = job
+    try:
+        _save_image(processed_array, processed_path, encode_opts)
+        return stem, processed_path, True, f"🖼️ Saved: {processed_path}"
+    except Exception as e:
+        return _skipped(job, e)
+
+
+def _process_array(job: tuple, array: np.ndarray) -> tuple:
+    """
+    Run process_fn on an already decoded image and save the result.
+
+    Args:
+        job (tuple): (input_path, processed_path, stem, process_fn, encode_opts).
+        array (np.ndarray): Decoded image.
+
+    Returns:
+        tuple: (stem, processed_path, ok, message).
+    """
+    try:
+        processed_array = _apply(job[3], array)
+    except Exception as e:
+        return _skipped(job, e)
+
+    return _save_result(job, processed_array)
+
+
+def _process_one(job: tuple) -> tuple:
+    """
+    Decode, process and save a single image.
+
+    Lives at module scope so it can be pickled into worker processes; the
+    process_fn inside job must be importable (e.g. black_roi) for the same reason.
+
+    Args:
+        job (tuple): (input_path, processed_path, stem, process_fn, encode_opts).
+
+    Returns:
+        tuple: (stem, processed_path, ok, message).
+    """
+    try:
+        array = _load_image(job[0])
+    except Exception as e:
+        return _skipped(job, e)
+
+    return _process_array(job, array)
+
+
+def _process_bytes(job: tuple, data: bytes) -> tuple:
+    """Decode an already read image file, then process and save it."""
+    try:
+        array = _decode(data)
+    except Exception as e:
+        return _skipped(job, e)
+
+    return _process_array(job, array)
+
+
+def _picklable(obj) -> bool:
+    """Return True if obj can be sent to a worker process."""
+    try:
+        pickle.dumps(obj)
+        return True
+    except Exception:
+        return False
+
+
+def _mp_context():
+    """
+    Start method for worker processes.
+
+    The Streamlit app calls process_images from a script-runner thread in a
+    multi-threaded server, so forking could copy a held lock into a child.
+    Use forkserver where available, spawn otherwise.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def _run_pool(jobs: list[tuple]) -> Iterator[tuple]:
+    """Run _process_one over jobs on a CPU pool, yielding results in job order."""
+    # Pillow holds the GIL while decoding/encoding, so large batches go to
+    # worker processes; small ones stay on threads to avoid spawn overhead.
+    # Jobs carrying a process_fn that cannot be pickled (lambda, closure,
+    # local partial) always stay on threads.
+    workers = os.cpu_count() or 1
+    if len(jobs) > PROCESS_POOL_MIN_IMAGES and _picklable(jobs[0]):
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=_mp_context())
+        chunksize = max(1, len(jobs) // (workers * 4))
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+        chunksize = 1
+
+    try:
+        yield from executor.map(_process_one, jobs, chunksize=chunksize)
+    except GeneratorExit:
+        # Consumer stopped early: drop queued work, let running work finish
+        executor.shutdown(cancel_futures=True)
+        raise
+    except BaseException:
+        # Waiting here can deadlock a broken process pool, so don't
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    else:
+        executor.shutdown()
+
+
+def _prefetch_bytes(paths: list[Path], depth: int = PREFETCH_DEPTH) -> Iterator[Optional[bytes]]:
+    """
+    Yield the contents of paths in order, keeping up to depth reads in flight.
+
+    Reads run on a small thread pool so the next files are already in memory
+    while the consumer decodes the current ones. Unreadable files yield None.
+    """
+    def read(path: Path) -> Optional[bytes]:
+        try:
+            return path.read_bytes()
+        except OSError:
+            return None
+
+    with ThreadPoolExecutor(max_workers=PREFETCH_THREADS) as executor:
+        window = deque()
+        for path in paths:
+            window.append(executor.submit(read, path))
+            if len(window) >= depth:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
+
+
+def _run_nvimgcodec(jobs: list[tuple], decoder) -> Iterator[tuple]:
+    """
+    Decode jobs in batches on the GPU with nvImageCodec, then process and save
+    on a thread pool.
+
+    Only JPEGs go to the GPU, which decodes to 8-bit RGB; grayscale JPEGs are
+    cut back to one channel to match the CPU path. Other formats keep their
+    mode and bit depth by going through _decode on the thread pool.
+
+    File reads are prefetched so the next batch is loaded while the current
+    one decodes. process_fn works on NumPy arrays, so each decoded image is
+    copied back to host memory before processing. Files that could not be
+    read, or that the GPU decoder cannot handle, fall back to the CPU path.
+    """
+    with closing(_prefetch_bytes([job[0] for job in jobs])) as reads, \
+            ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+        for start in range(0, len(jobs), NVIMGCODEC_BATCH_SIZE):
+            batch = jobs[start:start + NVIMGCODEC_BATCH_SIZE]
+            datas = list(itertools.islice(reads, len(batch)))
+
+            images = [None] * len(batch)
+            jpegs = [
+                i for i, data in enumerate(datas)
+                if data is not None and _sniff(data[:16]) == 'jpeg'
+            ]
+            try:
+                decoded = decoder.decode([datas[i] for i in jpegs])
+                for i, image in zip(jpegs, decoded):
+                    images[i] = image
+            except Exception:
+                # Let the CPU path decode (and report) this batch file by file
+                pass
+
+            futures = []
+            for job, data, image in zip(batch, datas, images):
+                if image is not None:
+                    array = np.asarray(image.cpu())
+                    if _jpeg_components(data) == 1:
+                        array = array[:, :, 0]
+                    futures.append(executor.submit(_process_array, job, array))
+                elif data is not None:
+                    futures.append(executor.submit(_process_bytes, job, data))
+                else:
+                    futures.append(executor.submit(_process_one, job))
+
+            for future in futures:
+                yield future.result()
+
+
+# SPDL drops items whose stage raises, so each stage passes (job, value, error)
+# along and only the last one turns it into a result tuple.
+def _read_stage(job: tuple) -> tuple:
+    try:
+        return job, job[0].read_bytes(), None
+    except Exception as e:
+        return job, None, e
+
+
+def _decode_stage(item: tuple) -> tuple:
+    job, data, error = item
+    if error is not None:
+        return item
+    try:
+        return job, _decode(data), None
+    except Exception as e:
+        return job, None, e
+
+
+def _process_stage(item: tuple) -> tuple:
+    job, array, error = item
+    if error is not None:
+        return item
+    try:
+        return job, _apply(job[3], array), None
+    except Exception as e:
+        return job, None, e
+
+
+def _save_stage(item: tuple) -> tuple:
+    job, array, error = item
+    if error is not None:
+        return _skipped(job, error)
+    return _save_result(job, array)
+
+
+def _run_spdl(jobs: list[tuple]) -> Iterator[tuple]:
+    """
+    Run read -> decode -> process -> save as an SPDL pipeline.
+
+    Each stage has its own thread budget, so file reads and writes overlap
+    with decoding and process_fn instead of alternating with them. Results
+    arrive in completion order.
+    """
+    workers = os.cpu_count() or 1
+    pipeline = (
+        PipelineBuilder()
+        .add_source(jobs)
+        .pipe(_read_stage, concurrency=SPDL_READ_CONCURRENCY)
+        .pipe(_decode_stage, concurrency=workers)
+        .pipe(_process_stage, concurrency=workers)
+        .pipe(_save_stage, concurrency=SPDL_SAVE_CONCURRENCY)
+        .add_sink(64)
+        .build(num_threads=workers + SPDL_READ_CONCURRENCY + SPDL_SAVE_CONCURRENCY)
+    )
+    with pipeline.auto_stop():
+        yield from pipeline
+
+
+def process_images(input_folder: Path, process_fn: Callable, output_folder_name="output", ocr_results=None, backend="auto", encode_opts: Optional[EncodeOpts] = None) -> Iterator[str]:
+    """
+    Process every image under input_folder, yielding each stem once it is saved.
+
+    This is a generator, so downstream stages can start on early results
+    while the rest of the folder is still being processed. Nothing runs
+    until it is iterated; use process_images_list to collect all stems.
+
+    process_fn receives a writable array and may modify it in place.
+
+    Large folders are processed in worker processes, which requires
+    process_fn to be picklable, i.e. a module-level function such as
+    black_roi. Other callables (lambdas, closures) still work but run on
+    threads in this process.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}; expected one of {BACKENDS}")
 
-def process_images(input_folder: Path, process_fn: Callable, output_folder_name="output", ocr_results=None) -> list[str]:
     output_folder = input_folder / output_folder_name
     output_folder.mkdir(parents=True, exist_ok=True)
 
+    # OCR prefix per stem, built once instead of per image
+    prefix_map = {
+        stem: f"{texts['X'][0]}_{texts['X'][1]}_"
+        for stem, texts in (ocr_results or {}).items()
+        if len(texts.get('X', ())) >= 2
+    }
+
     # Create log file
     log_path = output_folder / "process_log.txt"
-    log_file = open(log_path, "a", encoding="utf-8")
+    log_file = open(log_path, "a", encoding="utf-8", buffering=1 << 16)
+    pending = []
 
     def log(message: str):
         print(message)
-        log_file.write(message + "\n")
-
-    original_stems = []
+        pending.append(message + "\n")
+        if len(pending) >= LOG_FLUSH_LINES:
+            log_file.writelines(pending)
+            pending.clear()
 
     # Counters for summary
     processed_count = 0
     skipped_count = 0
     total_images = 0
 
-    for root, dirs, files in os.walk(input_folder):
-        root_path = Path(root)
+    if encode_opts is None:
+        encode_opts = EncodeOpts()
 
+    # The summary is written even if the consumer stops iterating early
+    try:
+        # Collect jobs up front so they can be handed to the pool. Output
+        # directories are created here, once each, rather than per file in workers.
+        jobs = []
+        created_dirs: set[Path] = {output_folder}
         # Prevent recursive processing of output folder
-        if output_folder in root_path.parents or root_path == output_folder:
-            continue
-
-        for file in files:
-            if file.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.tiff', '.gif')):
-                total_images += 1
-                input_path = root_path / file
-                relative_path = input_path.relative_to(input_folder)
-
-                stem, suffix = relative_path.stem, relative_path.suffix
+        for entry, rel_parent in _iter_images(input_folder, {output_folder}):
+            stem, suffix = os.path.splitext(entry.name)
+            stem = sys.intern(stem)
+            ocr_text = prefix_map.get(stem, "")
 
-                # OCR prefix
-                ocr_text = ""
-                if ocr_results and stem in ocr_results:
-                    x_vals = ocr_results[stem].get('X', [])
-                    if len(x_vals) >= 2:
-                        ocr_text = f"{x_vals[0]}_{x_vals[1]}_"
+            processed_name = f"{ocr_text}{stem}{suffix}"
+            parent = output_folder.joinpath(*rel_parent)
+            if parent not in created_dirs:
+                parent.mkdir(parents=True, exist_ok=True)
+                created_dirs.add(parent)
+            processed_path = parent / processed_name
+            jobs.append((Path(entry.path), processed_path, stem, process_fn, encode_opts))
 
-                processed_name = f"{ocr_text}{stem}{suffix}"
-                processed_path = output_folder / relative_path.parent / processed_name
-                processed_path.parent.mkdir(parents=True, exist_ok=True)
+        total_images = len(jobs)
 
-                # Try processing
+        # backend="nvimgcodec" decodes on the GPU, backend="spdl" runs a staged
+        # SPDL pipeline; anything else uses the CPU pool
+        run = _run_pool
+        if backend == "nvimgcodec":
+            if nvimgcodec is None:
+                log("⚠️ nvImageCodec is not installed; falling back to CPU decoding")
+            else:
+                # Decoder() fails when no CUDA device or driver is available
                 try:
-                    with Image.open(input_path) as img:
-                        array = np.array(img)
-                        processed_array = process_fn(array)
-                        Image.fromarray(processed_array).save(processed_path)
+                    run = partial(_run_nvimgcodec, decoder=nvimgcodec.Decoder())
+                except Exception as e:
+                    log(f"⚠️ nvImageCodec GPU decoder unavailable ({e}); falling back to CPU decoding")
+        elif backend == "spdl":
+            if PipelineBuilder is None:
+                log("⚠️ SPDL is not installed; falling back to the CPU pool")
+            else:
+                run = _run_spdl
 
-                    log(f"🖼️ Saved: {processed_path}")
-                    original_stems.append(stem)
-                    processed_count += 1
+        with closing(run(jobs)) as results:
+            for stem, processed_path, ok, message in results:
+                log(message)
 
-                except Exception as e:
-                    log(f"⚠️ Skipped unsupported or corrupted file: {input_path} ({e})")
+                if ok:
+                    processed_count += 1
+                    yield stem
+                else:
                     skipped_count += 1
-                    continue
-
-    # Summary
-    summary = (
-        "\n========== PROCESS SUMMARY ==========\n"
-        f"Total images scanned : {total_images}\n"
-        f"Successfully processed: {processed_count}\n"
-        f"Skipped (errors)     : {skipped_count}\n"
-        "=====================================\n"
-    )
 
-    print(summary)
-    log_file.write(summary)
-    log_file.close()
+    finally:
+        # Summary
+        summary = (
+            "\n========== PROCESS SUMMARY ==========\n"
+            f"Total images scanned : {total_images}\n"
+            f"Successfully processed: {processed_count}\n"
+            f"Skipped (errors)     : {skipped_count}\n"
+            f"Pillow build         : {PIL_VERSION}{' (SIMD)' if PILLOW_SIMD else ''}\n"
+            "=====================================\n"
+        )
+
+        print(summary)
+        pending.append(summary)
+        log_file.writelines(pending)
+        log_file.close()
+
 
-    return original_stems
+def process_images_list(*args, **kwargs) -> list[str]:
+    """Run process_images to completion and return the processed stems as a list."""
+    return list(process_images(*args, **kwargs))
@@ -8,7 +8,7 @@ and the base folder name: <Ref-X1>_<Ref-X2>_<base_name>.<ext>.
 
 import streamlit as st
 from black_roi.blackening_roi import black_roi
-from black_roi.folder_importer import process_images
+from black_roi.folder_importer import collect_image_files_recursive, is_image_name, process_images_list
 
 from ocr_process.image_processor import process_roi_x, process_roi_y
 from ocr_process.text_extractor import extract_from_image
@@ -60,10 +60,6 @@ def extract_archives_if_needed(file_paths, extract_dir):
     return extracted_folders
 
 
-def collect_image_files_recursive(root_folder: Path, image_extensions=('.png', '.jpg', '.jpeg', '.tif', '.tiff')):
-    return [p for p in root_folder.rglob("*") if p.suffix.lower() in image_extensions and p.is_file()]
-
-
 def zip_folder(folder_path: Path, zip_name: Path):
     shutil.make_archive(str(zip_name.with_suffix('')), 'zip', str(folder_path))
     return zip_name
@@ -103,7 +99,7 @@ def run_pipeline(image_folder: Path, image_files: list[Path], base_name: str):
     intermediate_csv = output_folder / f"{base_name}.csv"
 
     # Black ROI: writes processed images into output_folder
-    process_images(image_folder, black_roi, output_folder_name=output_folder.name)
+    process_images_list(image_folder, black_roi, output_folder_name=output_folder.name)
     if intermediate_csv.exists():
         os.remove(intermediate_csv)
 
@@ -132,7 +128,8 @@ def run_pipeline(image_folder: Path, image_files: list[Path], base_name: str):
 
 def show_image_gallery(folder: Path):
     image_files = sorted(folder.glob("*"))
-    images = [Image.open(img) for img in image_files if img.suffix.lower() in [".png", ".jpg", ".jpeg", ".tif", ".tiff"]]
+    image_files = [img for img in image_files if is_image_name(img.name)]
+    images = [Image.open(img) for img in image_files]
     if images:
         st.markdown("### 🖼️ Preview of Processed Images:")
         cols = st.columns(3)
@@ -160,7 +157,7 @@ if uploaded_files:
                 extracted_dirs = extract_archives_if_needed(file_paths, Path(temp_dir))
                 archive_file = next((f for f in file_paths if f.suffix.lower() in [".zip", ".rar", ".7z"]), None)
                 base_name = archive_file.stem if archive_file else image_folder.name
-                all_images = [f for f in file_paths if f.suffix.lower() in [".png", ".jpg", ".jpeg", ".tif", ".tiff"]]
+                all_images = [f for f in file_paths if is_image_name(f.name)]
                 for d in extracted_dirs:
                     all_images += collect_image_files_recursive(d)
                 if not all_images: